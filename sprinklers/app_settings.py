@@ -2,3 +2,11 @@ from django.conf import settings
 
 
 SPRINKLER_DEFAULT_SHARD_SIZE = getattr(settings, 'SPRINKLER_DEFAULT_SHARD_SIZE', 20000)
+SPRINKLER_AUTODISCOVER = getattr(settings, 'SPRINKLER_AUTODISCOVER', True)
+SPRINKLER_AUTODISCOVER_MODULE = getattr(settings, 'SPRINKLER_AUTODISCOVER_MODULE', 'sprinklers')
+SPRINKLER_DEDUP_CACHE = getattr(settings, 'SPRINKLER_DEDUP_CACHE', 'default')
+SPRINKLER_DEDUP_TIMEOUT = getattr(settings, 'SPRINKLER_DEDUP_TIMEOUT', 60 * 60 * 24)
+SPRINKLER_DEDUP_BATCH_SIZE = getattr(settings, 'SPRINKLER_DEDUP_BATCH_SIZE', 1000)
+SPRINKLER_DEDUP_BUCKET_SIZE = getattr(settings, 'SPRINKLER_DEDUP_BUCKET_SIZE', 4096)
+SPRINKLER_DEDUP_CLAIM_TIMEOUT = getattr(settings, 'SPRINKLER_DEDUP_CLAIM_TIMEOUT', 60 * 60)
+SPRINKLER_DEDUP_RETRY_COUNTDOWN = getattr(settings, 'SPRINKLER_DEDUP_RETRY_COUNTDOWN', 60)
@@ -1,6 +1,7 @@
 from . import app_settings
-from celery import chord, current_app, Task
-from .registry import sprinkler_registry as registry
+from celery import chord, current_app, current_task, Task
+from .dedup import ProcessedSet, SubtaskInProgress
+from .registry import sprinkler_registry as registry, sprinkler_path
 import logging
 import uuid
 from time import time
@@ -8,7 +9,7 @@ from time import time
 logger = logging.getLogger('')
 
 
-def async_subtask(obj_pk, sprinkler_name, kwargs):
+def async_subtask(obj_pk, sprinkler_name, kwargs, run_id=None):
     """
     async_subtask -- inner implementation of :func:`_async_subtask`
 
@@ -33,29 +34,44 @@ def async_subtask(obj_pk, sprinkler_name, kwargs):
     ...
     >>> SomeSprinkler().start()
     """
-    return registry[sprinkler_name](**kwargs)._run_subtask(obj_pk)
+    sprinkler = _get_sprinkler(sprinkler_name, kwargs, run_id)
+    try:
+        return sprinkler._run_subtask(obj_pk)
+    except SubtaskInProgress as e:
+        # another delivery is working on this object; come back once it is done or its claim expires
+        sprinkler.log("Retrying object %s: %s" % (obj_pk, e))
+        raise current_task.retry(exc=e, countdown=app_settings.SPRINKLER_DEDUP_RETRY_COUNTDOWN, max_retries=None)
+
+
+def _get_sprinkler(sprinkler_name, kwargs, run_id=None):
+    sprinkler = registry[sprinkler_name](**kwargs)
+    sprinkler.run_id = run_id
+    return sprinkler
 
 
 _async_subtask = current_app.task(async_subtask)
 
 
 @current_app.task()
-def _async_shard_start(shard_id, from_pk, to_pk, sprinkler_name, kwargs):
-    sprinkler = registry[sprinkler_name](**kwargs)
+def _async_shard_start(shard_id, from_pk, to_pk, sprinkler_name, kwargs, run_id=None):
+    sprinkler = _get_sprinkler(sprinkler_name, kwargs, run_id)
     return sprinkler.shard_start(shard_id, from_pk, to_pk)
 
 
 @current_app.task()
-def _sprinkler_shard_finished_wrap(results, shard_id, sprinkler_name, kwargs):
-    sprinkler = registry[sprinkler_name](**kwargs)
+def _sprinkler_shard_finished_wrap(results, shard_id, sprinkler_name, kwargs, run_id=None, from_pk=None, to_pk=None):
+    sprinkler = _get_sprinkler(sprinkler_name, kwargs, run_id)
     sprinkler.log(f"shard finished: {shard_id}")
+    sprinkler._compact_processed(from_pk, to_pk)
     sprinkler.shard_finished(shard_id, results)
 
 
 @current_app.task()
-def _sprinkler_finished_wrap(results, sprinkler_name, kwargs):
-    sprinkler = registry[sprinkler_name](**kwargs)
+def _sprinkler_finished_wrap(results, sprinkler_name, kwargs, run_id=None):
+    sprinkler = _get_sprinkler(sprinkler_name, kwargs, run_id)
     sprinkler.log("Finished with results (length %s): %s" % (len(results), results))
+    if sprinkler.processed_set is not None:
+        sprinkler.log("Skipped %s duplicate deliveries." % sprinkler.processed_set.duplicates())
     sprinkler.finished(results)
 
 
@@ -66,16 +82,27 @@ class SubtaskValidationException(Exception):
 class SprinklerBase(object):
     subtask_queue = current_app.conf.CELERY_DEFAULT_QUEUE
     klass = None
+    # Opt in to skipping subtasks for objects already processed in the same run, e.g. when
+    # a message is redelivered under acks_late. Requires a cache shared by all workers.
+    dedupe_subtasks = False
+    run_id = None
 
     def __init__(self, **kwargs):
         self.kwargs = kwargs
         if self.klass is None:
             self.klass = self.get_queryset().model
 
-    def start(self):
+    def start(self, run_id=None):
+        """ Pass the run_id of an earlier run to resume it; with dedupe_subtasks, objects it
+            already processed are skipped."""
+        self._start_run(run_id)
         qs = self.get_queryset()
         ids = [o['id'] if isinstance(o, dict) else o.id for o in qs]
 
+        processed_set = self.processed_set
+        if run_id is not None and processed_set is not None:
+            ids = list(processed_set.unprocessed(ids))
+
         async_subtask = (
             self._async_subtask
             if isinstance(getattr(self, '_async_subtask', None), Task)
@@ -86,11 +113,11 @@ class SprinklerBase(object):
             (
                 # .s is shorthand for .signature()
                 async_subtask
-                .s(i, self.__class__.__name__, self.kwargs)
+                .s(i, self._sprinkler_name, self.kwargs, self.run_id)
                 .set(queue=self.get_subtask_queue())
                 for i in ids
             ),
-            _sprinkler_finished_wrap.s(sprinkler_name=self.__class__.__name__, kwargs=self.kwargs).set(queue=self.get_subtask_queue())
+            _sprinkler_finished_wrap.s(sprinkler_name=self._sprinkler_name, kwargs=self.kwargs, run_id=self.run_id).set(queue=self.get_subtask_queue())
         )
 
         start_time = time()
@@ -101,6 +128,25 @@ class SprinklerBase(object):
         self.log("Started with %s objects in %sms." % (len(ids), duration))
         self.log("Started with objects: %s" % ids)
 
+    def _start_run(self, run_id=None):
+        self.run_id = run_id or uuid.uuid4().hex
+        processed_set = self.processed_set
+        if processed_set is not None and not processed_set.is_shared:
+            logger.warning("SPRINKLER %s: dedupe_subtasks is set but SPRINKLER_DEDUP_CACHE is a per-process "
+                           "cache, so deliveries on other workers won't be deduplicated." % self)
+
+    @property
+    def _sprinkler_name(self):
+        # Tasks look sprinklers up by dotted path so workers can import them lazily
+        # and same-named sprinklers in different apps don't clash.
+        return sprinkler_path(self.__class__)
+
+    @property
+    def processed_set(self):
+        if self.dedupe_subtasks and self.run_id is not None:
+            return ProcessedSet(self.run_id)
+        return None
+
     def finished(self, results):
         pass
 
@@ -132,24 +178,40 @@ class SprinklerBase(object):
 
     def _run_subtask(self, obj_pk):
         """Executes the sprinkle pipeline. Should not be overridden."""
+        processed_set = self.processed_set
+        # raises SubtaskInProgress if another delivery holds the claim, so the task is retried
+        if processed_set is not None and not processed_set.claim(obj_pk):
+            self.log("Object <%s - %s> was already processed in run %s." % (self.klass.__name__, obj_pk, self.run_id))
+            return None
+
         obj = None
         try:
             obj = self.klass.objects.get(pk=obj_pk)
             self._log_execution_step(self.validate, obj)
             # if subtask() doesn't return a value, return the object id so something more helpful than None
             # gets aggregated into the results object (passed to 'finish').
-            return self._log_execution_step(self.subtask, obj) or obj.id
+            result = self._log_execution_step(self.subtask, obj) or obj.id
         except self.klass.DoesNotExist:
             self.log("Object <%s - %s> does not exist." % (self.klass.__name__, obj_pk))
+            if processed_set is not None:
+                processed_set.release(obj_pk)
+            return None
         except SubtaskValidationException as e:
             self.log("Validation failed for object %s: %s" % (obj, e))
-            return self.on_validation_exception(obj, e)
+            result = self.on_validation_exception(obj, e)
         except Exception as e:
+            if processed_set is not None:
+                processed_set.release(obj_pk)
             if obj is not None:
                 self.log("Unexpected exception for object %s: %s" % (obj, e))
                 return self.on_error(obj, e)
             raise e
 
+        # outside the try, so a failure to record a finished subtask can't be reported as its error
+        if processed_set is not None:
+            processed_set.add(obj_pk)
+        return result
+
     def _log_execution_step(self, fn, obj):
         fn_name = fn.__name__.split('.')[-1]
         self.log("%s is starting for object %s." % (fn_name, obj))
@@ -167,7 +229,8 @@ class SprinklerBase(object):
 class ShardedSprinkler(SprinklerBase):
     shard_size = app_settings.SPRINKLER_DEFAULT_SHARD_SIZE
 
-    def start(self):
+    def start(self, run_id=None):
+        self._start_run(run_id)
         shards = list(self.build_shards())
 
         # the sharded sprinkler calls finished on output of shard_start for each shard, passing the shard ID,
@@ -175,10 +238,10 @@ class ShardedSprinkler(SprinklerBase):
 
         c = chord(
             (
-                _async_shard_start.s(shard_id, from_pk, to_pk, self.__class__.__name__, self.kwargs).set(queue=self.get_subtask_queue())
+                _async_shard_start.s(shard_id, from_pk, to_pk, self._sprinkler_name, self.kwargs, self.run_id).set(queue=self.get_subtask_queue())
                 for shard_id, from_pk, to_pk in shards
             ),
-            _sprinkler_finished_wrap.s(sprinkler_name=self.__class__.__name__, kwargs=self.kwargs).set(queue=self.get_subtask_queue())
+            _sprinkler_finished_wrap.s(sprinkler_name=self._sprinkler_name, kwargs=self.kwargs, run_id=self.run_id).set(queue=self.get_subtask_queue())
         )
 
         start_time = time()
@@ -194,12 +257,18 @@ class ShardedSprinkler(SprinklerBase):
     def shard_start(self, shard_id, from_pk=None, to_pk=None):
         pks = self.get_queryset_pks(from_pk, to_pk)
 
+        # a redelivered or resumed shard only needs to dispatch the objects that haven't been processed yet
+        processed_set = self.processed_set
+        if processed_set is not None and not processed_set.start_shard(from_pk, to_pk):
+            pks = processed_set.unprocessed(pks)
+
         c = chord(
             (
-                _async_subtask.s(pk, self.__class__.__name__, self.kwargs).set(queue=self.get_subtask_queue())
+                _async_subtask.s(pk, self._sprinkler_name, self.kwargs, self.run_id).set(queue=self.get_subtask_queue())
                 for pk in pks
             ),
-            _sprinkler_shard_finished_wrap.s(sprinkler_name=self.__class__.__name__, shard_id=shard_id, kwargs=self.kwargs).set(queue=self.get_subtask_queue())
+            _sprinkler_shard_finished_wrap.s(sprinkler_name=self._sprinkler_name, shard_id=shard_id, kwargs=self.kwargs, run_id=self.run_id,
+                                               from_pk=from_pk, to_pk=to_pk).set(queue=self.get_subtask_queue())
         )
 
         start_time = time()
@@ -214,8 +283,16 @@ class ShardedSprinkler(SprinklerBase):
     def shard_finished(self, shard_id, results):
         pass
 
-    def get_queryset_pks(self, from_pk=None, to_pk=None):
-        queryset = self.get_queryset().only('pk').order_by('pk')
+    def _compact_processed(self, from_pk, to_pk):
+        processed_set = self.processed_set
+        if processed_set is not None:
+            # the whole table range, not get_queryset(), which may no longer match processed objects
+            processed_set.compact(self.get_queryset_pks(from_pk, to_pk, queryset=self.klass.objects.all()))
+
+    def get_queryset_pks(self, from_pk=None, to_pk=None, queryset=None):
+        if queryset is None:
+            queryset = self.get_queryset()
+        queryset = queryset.only('pk').order_by('pk')
 
         if from_pk is not None:
             queryset = queryset.filter(pk__gt=from_pk)
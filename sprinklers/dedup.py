@@ -0,0 +1,223 @@
+from . import app_settings
+from bisect import bisect_right
+from collections import defaultdict
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from itertools import islice
+from time import sleep
+import logging
+
+logger = logging.getLogger('')
+
+IN_PROGRESS = 'in-progress'
+DONE = 'done'
+
+BUCKET_LOCK_TIMEOUT = 5
+BUCKET_LOCK_ATTEMPTS = 50
+BUCKET_LOCK_WAIT = 0.01
+
+
+class SubtaskInProgress(Exception):
+    """ Another delivery holds the claim on this object; retry once it finishes or expires."""
+    pass
+
+
+def ranges_contain(ranges, pk):
+    i = bisect_right(ranges, [pk, float('inf')])
+    return i > 0 and ranges[i - 1][1] >= pk
+
+
+def ranges_add(ranges, pk):
+    """ Add pk to a sorted list of disjoint [start, end] ranges, merging neighbours in place."""
+    i = bisect_right(ranges, [pk, float('inf')])
+    if i > 0 and ranges[i - 1][1] >= pk:
+        return ranges
+
+    joins_left = i > 0 and ranges[i - 1][1] == pk - 1
+    joins_right = i < len(ranges) and ranges[i][0] == pk + 1
+    if joins_left and joins_right:
+        ranges[i - 1][1] = ranges.pop(i)[1]
+    elif joins_left:
+        ranges[i - 1][1] = pk
+    elif joins_right:
+        ranges[i][0] = pk
+    else:
+        ranges.insert(i, [pk, pk])
+    return ranges
+
+
+def _batches(iterable):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, app_settings.SPRINKLER_DEDUP_BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+class ProcessedSet(object):
+    """ The pks that have made it through the subtask pipeline in a single sprinkler run.
+
+        Each delivery claims its pk with an atomic ``cache.add`` before doing any work and
+        marks the claim done when it finishes. A delivery that finds the claim still in
+        progress raises :class:`SubtaskInProgress` rather than skipping, so work held by a
+        killed worker is retried once its claim expires instead of being dropped.
+
+        Done marks are folded in bulk, once per finished shard, into range-compressed buckets
+        of ``SPRINKLER_DEDUP_BUCKET_SIZE`` consecutive integer pks, so a run's record stays
+        small however many rows it touches.
+
+        Cache errors are logged and treated as "not processed": a cache outage degrades to
+        running subtasks without dedup rather than failing them."""
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.cache = caches[app_settings.SPRINKLER_DEDUP_CACHE]
+
+    @property
+    def is_shared(self):
+        """ Whether the cache can be seen by other worker processes."""
+        return not isinstance(self.cache, (LocMemCache, DummyCache))
+
+    def _claim_key(self, pk):
+        return "sprinklers:%s:claim:%s" % (self.run_id, pk)
+
+    def _bucket_key(self, pk):
+        return "sprinklers:%s:processed:%s" % (self.run_id, pk // app_settings.SPRINKLER_DEDUP_BUCKET_SIZE)
+
+    def _shard_key(self, from_pk, to_pk):
+        return "sprinklers:%s:shard:%s:%s" % (self.run_id, from_pk, to_pk)
+
+    def _duplicates_key(self):
+        return "sprinklers:%s:duplicates" % self.run_id
+
+    def _is_done(self, pk, found):
+        if found.get(self._claim_key(pk)) == DONE:
+            return True
+        return isinstance(pk, int) and ranges_contain(found.get(self._bucket_key(pk), []), pk)
+
+    def _keys(self, pk):
+        if isinstance(pk, int):
+            return [self._claim_key(pk), self._bucket_key(pk)]
+        return [self._claim_key(pk)]
+
+    def __contains__(self, pk):
+        return self._is_done(pk, self.cache.get_many(self._keys(pk)))
+
+    def claim(self, pk):
+        """ Atomically claim pk for this delivery.
+
+            Returns False if pk has already been processed in this run, and raises
+            SubtaskInProgress if another delivery holds the claim."""
+        claim_key = self._claim_key(pk)
+        try:
+            if self.cache.add(claim_key, IN_PROGRESS, app_settings.SPRINKLER_DEDUP_CLAIM_TIMEOUT):
+                # A compacted pk has no claim key left, so the add can succeed; buckets are
+                # written before claim keys are dropped, so checking afterwards is race-free.
+                if isinstance(pk, int) and ranges_contain(self.cache.get(self._bucket_key(pk), []), pk):
+                    self.cache.delete(claim_key)
+                    self.record_duplicates()
+                    return False
+                return True
+            state = self.cache.get(claim_key)
+        except Exception as e:
+            logger.warning("SPRINKLER run %s: could not claim %s, running without dedup: %s" % (self.run_id, pk, e))
+            return True
+
+        if state == DONE:
+            self.record_duplicates()
+            return False
+        # in progress elsewhere, or released/expired since the add; either way try again later
+        raise SubtaskInProgress("%s is claimed by another delivery in run %s" % (pk, self.run_id))
+
+    def release(self, pk):
+        """ Drop the claim on pk so a later delivery can retry it."""
+        try:
+            self.cache.delete(self._claim_key(pk))
+        except Exception as e:
+            logger.warning("SPRINKLER run %s: could not release claim on %s: %s" % (self.run_id, pk, e))
+
+    def add(self, pk):
+        """ Record pk as processed."""
+        try:
+            self.cache.set(self._claim_key(pk), DONE, app_settings.SPRINKLER_DEDUP_TIMEOUT)
+        except Exception as e:
+            logger.warning("SPRINKLER run %s: could not mark %s as processed: %s" % (self.run_id, pk, e))
+
+    def start_shard(self, from_pk, to_pk):
+        """ Returns False if a shard with these bounds was already started in this run."""
+        try:
+            return self.cache.add(self._shard_key(from_pk, to_pk), 1, app_settings.SPRINKLER_DEDUP_TIMEOUT)
+        except Exception as e:
+            logger.warning("SPRINKLER run %s: could not record shard start: %s" % (self.run_id, e))
+            return True
+
+    def unprocessed(self, pks):
+        """ Yield the pks not yet processed, checking the cache a batch at a time.
+
+            Claimed pks are still yielded: their delivery may yet fail and release the claim."""
+        for batch in _batches(pks):
+            try:
+                found = self.cache.get_many({key for pk in batch for key in self._keys(pk)})
+            except Exception as e:
+                logger.warning("SPRINKLER run %s: could not check processed objects: %s" % (self.run_id, e))
+                found = {}
+
+            skipped = 0
+            for pk in batch:
+                if self._is_done(pk, found):
+                    skipped += 1
+                else:
+                    yield pk
+            if skipped:
+                self.record_duplicates(skipped)
+
+    def compact(self, pks):
+        """ Fold the done marks of pks into their range buckets and drop the per-pk keys."""
+        try:
+            for batch in _batches(pk for pk in pks if isinstance(pk, int)):
+                claims = self.cache.get_many([self._claim_key(pk) for pk in batch])
+                buckets = defaultdict(list)
+                for pk in batch:
+                    if claims.get(self._claim_key(pk)) == DONE:
+                        buckets[self._bucket_key(pk)].append(pk)
+                for bucket_key, bucket_pks in buckets.items():
+                    if self._add_to_bucket(bucket_key, bucket_pks):
+                        self.cache.delete_many([self._claim_key(pk) for pk in bucket_pks])
+        except Exception as e:
+            logger.warning("SPRINKLER run %s: could not compact processed objects: %s" % (self.run_id, e))
+
+    def _add_to_bucket(self, bucket_key, pks):
+        # Buckets can straddle shard boundaries, so folds from neighbouring shards take turns.
+        # This only runs once per finished shard; if the lock stays busy the per-pk marks are
+        # simply left in place.
+        lock_key = bucket_key + ':lock'
+        for _ in range(BUCKET_LOCK_ATTEMPTS):
+            if self.cache.add(lock_key, 1, BUCKET_LOCK_TIMEOUT):
+                try:
+                    ranges = self.cache.get(bucket_key, [])
+                    for pk in pks:
+                        ranges_add(ranges, pk)
+                    self.cache.set(bucket_key, ranges, app_settings.SPRINKLER_DEDUP_TIMEOUT)
+                finally:
+                    self.cache.delete(lock_key)
+                return True
+            sleep(BUCKET_LOCK_WAIT)
+        return False
+
+    def record_duplicates(self, count=1):
+        key = self._duplicates_key()
+        try:
+            if self.cache.add(key, count, app_settings.SPRINKLER_DEDUP_TIMEOUT):
+                return
+            try:
+                self.cache.incr(key, count)
+            except ValueError:
+                # the counter expired or was evicted since the add
+                self.cache.add(key, count, app_settings.SPRINKLER_DEDUP_TIMEOUT)
+        except Exception as e:
+            logger.warning("SPRINKLER run %s: could not count %s duplicates: %s" % (self.run_id, count, e))
+
+    def duplicates(self):
+        return self.cache.get(self._duplicates_key(), 0)
@@ -1,12 +1,135 @@
+from . import app_settings
+from django.apps import apps
+from django.utils.module_loading import import_string, module_has_submodule
+from importlib import import_module
+import logging
+import threading
+
+logger = logging.getLogger('')
+
+
+class AmbiguousSprinklerName(Exception):
+    pass
+
+
+def sprinkler_path(sprinkler):
+    """ Dotted import path of a sprinkler class, used as its registry key."""
+    return "%s.%s" % (sprinkler.__module__, sprinkler.__name__)
+
+
 class SprinklerRegistry(object):
+    """ Maps dotted paths (and, where unambiguous, bare class names) to sprinkler classes.
+
+        Sprinklers may be registered either as classes or as dotted path strings. Classes
+        registered by path are only imported the first time they are looked up, and the
+        ``SPRINKLER_AUTODISCOVER_MODULE`` module (or package) of each installed app is only
+        imported when a lookup can't be satisfied by what has already been registered.
+        Dotted paths inside a discovered module are trusted without an explicit register()."""
 
     def __init__(self):
-        self._registry = {}
+        self._paths = {}  # dotted path -> class, or None until first lookup
+        self._names = {}  # bare class name -> set of dotted paths
+        self._discovered_modules = []
+        self._pending_modules = []
+        self._discovered = False
+        # guards autodiscovery and pending imports when lookups run on a threads pool
+        self._lock = threading.RLock()
 
     def register(self, sprinkler):
-        self._registry[sprinkler.__name__] = sprinkler
+        path = sprinkler if isinstance(sprinkler, str) else sprinkler_path(sprinkler)
+        name = path.rsplit('.', 1)[-1]
+
+        if isinstance(sprinkler, str):
+            self._paths.setdefault(path, None)
+        else:
+            self._paths[path] = sprinkler
+
+        paths = self._names.setdefault(name, set())
+        paths.add(path)
+        if len(paths) > 1:
+            logger.warning("SPRINKLER registry: name %s is shared by %s; look it up by dotted path." % (
+                name, sorted(paths)))
+        return sprinkler
+
+    def autodiscover(self):
+        """ Find each installed app's sprinklers module without importing it."""
+        if self._discovered or not app_settings.SPRINKLER_AUTODISCOVER:
+            return
+        self._discovered = True
+        module_name = app_settings.SPRINKLER_AUTODISCOVER_MODULE
+        for app_config in apps.get_app_configs():
+            if module_has_submodule(app_config.module, module_name):
+                self._discovered_modules.append("%s.%s" % (app_config.name, module_name))
+        self._pending_modules = list(self._discovered_modules)
 
     def __getitem__(self, key):
-        return self._registry[key]
+        try:
+            return self._resolve(key)
+        except KeyError:
+            pass
+
+        with self._lock:
+            self.autodiscover()
+            self._import_pending(key)
+            if '.' in key and key not in self._paths:
+                if any(_in_module(key, m) for m in self._discovered_modules):
+                    self._import_discovered(key)
+                else:
+                    self._import_aliases(key)
+            return self._resolve(key)
+
+    def _resolve(self, key):
+        if '.' in key:
+            path = key
+        else:
+            paths = self._names[key]
+            if len(paths) > 1:
+                raise AmbiguousSprinklerName("%s matches %s" % (key, sorted(paths)))
+            path, = paths
+
+        sprinkler = self._paths[path]
+        if sprinkler is None:
+            sprinkler = self._import(path)
+        return sprinkler
+
+    def _import(self, path):
+        sprinkler = self._paths[path] = import_string(path)
+        # Tasks are dispatched by the defining path, which may differ from a re-exported
+        # path the sprinkler was registered under.
+        self._paths.setdefault(sprinkler_path(sprinkler), sprinkler)
+        return sprinkler
+
+    def _import_pending(self, key):
+        # A dotted key names its own module, so only that module (or a package containing it)
+        # needs importing.
+        pending = [m for m in self._pending_modules if '.' not in key or _in_module(key, m)]
+        for module in pending:
+            self._pending_modules.remove(module)
+            import_module(module)
+
+    def _import_discovered(self, key):
+        # Only trust paths that actually import to a sprinkler, so a stale or malformed key
+        # can't leave a bogus entry behind or instantiate some other callable.
+        from .base import SprinklerBase
+        try:
+            sprinkler = import_string(key)
+        except ImportError:
+            raise KeyError(key)
+        if not (isinstance(sprinkler, type) and issubclass(sprinkler, SprinklerBase)):
+            raise KeyError(key)
+        self.register(sprinkler)
+        self._paths[key] = sprinkler
+
+    def _import_aliases(self, key):
+        # The key may be the defining path of a class registered under a re-exported path;
+        # only same-named registrations can be that class.
+        for path in self._names.get(key.rsplit('.', 1)[-1], ()):
+            if self._paths[path] is None:
+                self._import(path)
+
+
+def _in_module(path, module):
+    return path.startswith(module + '.')
+
 
-sprinkler_registry = SprinklerRegistry()
\ No newline at end of file
+sprinkler_registry = SprinklerRegistry()
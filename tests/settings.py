@@ -80,6 +80,14 @@ DATABASES = {
 
 DISABLE_TRANSACTION_MANAGEMENT = True
 
+# Shared with the celery worker so subtask dedup works across processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'sprinklers_cache',
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
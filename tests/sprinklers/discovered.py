@@ -0,0 +1,16 @@
+from sprinklers.base import SprinklerBase, registry
+from tests.models import DummyModel
+
+
+class DiscoveredSprinkler(SprinklerBase):
+    """ Only ever imported through registry autodiscovery."""
+    klass = DummyModel
+
+    def get_queryset(self):
+        return DummyModel.objects.all()
+
+    def subtask(self, obj):
+        obj.name = "Discovered!"
+        obj.save()
+
+registry.register(DiscoveredSprinkler)
@@ -12,6 +12,14 @@ def run_sample_sprinkler(**kwargs):
 def run_sharded_sprinkler(**kwargs):
     ShardedSampleSprinkler(**kwargs).start()
 
+@task
+def run_deduped_sprinkler(run_id=None, **kwargs):
+    DedupedSampleSprinkler(**kwargs).start(run_id)
+
+@task
+def run_deduped_sharded_sprinkler(run_id=None, **kwargs):
+    DedupedShardedSampleSprinkler(**kwargs).start(run_id)
+
 class SampleSprinkler(SprinklerBase):
 
     def get_queryset(self):
@@ -91,3 +99,14 @@ class ShardedSampleSprinkler(ShardedSprinkler):
         return False
 
 registry.register(ShardedSampleSprinkler)
+
+
+class DedupedSampleSprinkler(SampleSprinkler):
+    dedupe_subtasks = True
+
+registry.register(DedupedSampleSprinkler)
+
+class DedupedShardedSampleSprinkler(ShardedSampleSprinkler):
+    dedupe_subtasks = True
+
+registry.register(DedupedShardedSampleSprinkler)
@@ -1,8 +1,16 @@
-from django.test import TransactionTestCase
+from django.core.cache import cache
+from django.test import SimpleTestCase, TransactionTestCase
+from sprinklers.dedup import ProcessedSet, SubtaskInProgress, ranges_add, ranges_contain
+from sprinklers.registry import AmbiguousSprinklerName, SprinklerRegistry, sprinkler_registry
 from tests.models import DummyModel
-from tests.tasks import run_sample_sprinkler, run_sharded_sprinkler, SampleSprinkler
+from tests.tasks import (run_sample_sprinkler, run_sharded_sprinkler, run_deduped_sprinkler,
+                         run_deduped_sharded_sprinkler, SampleSprinkler, DedupedSampleSprinkler,
+                         DedupedShardedSampleSprinkler)
 from django.conf import settings
+import sys
 import time
+import uuid
+from unittest import mock
 
 
 class SprinklerTest(TransactionTestCase):
@@ -23,6 +31,12 @@ class SprinklerTest(TransactionTestCase):
             time.sleep(2)
         return r.get()
 
+    def _run_deduped(self, task, **kwargs):
+        r = task.delay(**kwargs)
+        if not settings.CELERY_ALWAYS_EAGER:
+            time.sleep(2)
+        return r.get()
+
     def test_objects_get_sprinkled(self):
         DummyModel(name="foo").save()
         DummyModel(name="foo").save()
@@ -95,3 +109,230 @@ class SprinklerTest(TransactionTestCase):
             DummyModel(name="sharded").save()
         self._run_sharded(name="sharded")
         self.assertEqual(DummyModel.objects.filter(name="sharded").count(), 0)
+
+    def test_deduped_run(self):
+        DummyModel(name="foo").save()
+        DummyModel(name="foo").save()
+        run_id = uuid.uuid4().hex
+        self._run_deduped(run_deduped_sprinkler, run_id=run_id, persist_results=True, special_return=True)
+        self.assertEqual(DummyModel.objects.filter(name=str([True, True])).count(), 1)
+        self.assertEqual(ProcessedSet(run_id).duplicates(), 0)
+
+    def test_claimed_subtask_is_retried(self):
+        d = DummyModel(name="foo")
+        d.save()
+        sprinkler = DedupedSampleSprinkler()
+        sprinkler.run_id = uuid.uuid4().hex
+        # another delivery of the same pk is still running, or died holding the claim
+        self.assertTrue(sprinkler.processed_set.claim(d.id))
+        with self.assertRaises(SubtaskInProgress):
+            sprinkler._run_subtask(d.id)
+        self.assertTrue(DummyModel.objects.filter(name="foo").exists())
+        self.assertEqual(sprinkler.processed_set.duplicates(), 0)
+
+        # once the claim is gone the retry does the work
+        sprinkler.processed_set.release(d.id)
+        sprinkler._run_subtask(d.id)
+        self.assertTrue(DummyModel.objects.filter(name="Sprinkled!").exists())
+
+    def test_resumed_run_skips_processed(self):
+        done = DummyModel(name="foo")
+        done.save()
+        DummyModel(name="foo").save()
+        run_id = uuid.uuid4().hex
+        ProcessedSet(run_id).add(done.id)
+        self._run_deduped(run_deduped_sprinkler, run_id=run_id, persist_results=True, special_return=True)
+        self.assertEqual(DummyModel.objects.filter(name=str([True])).count(), 1)
+        self.assertEqual(DummyModel.objects.get(pk=done.id).name, "foo")
+        self.assertEqual(ProcessedSet(run_id).duplicates(), 1)
+
+    def test_redelivered_subtask_is_skipped(self):
+        d = DummyModel(name="foo")
+        d.save()
+        sprinkler = DedupedSampleSprinkler(special_return=True)
+        sprinkler.run_id = uuid.uuid4().hex
+        self.assertTrue(sprinkler._run_subtask(d.id))
+        DummyModel.objects.filter(pk=d.id).update(name="foo")
+        self.assertIsNone(sprinkler._run_subtask(d.id))
+        self.assertTrue(DummyModel.objects.filter(name="foo").exists())
+        self.assertEqual(sprinkler.processed_set.duplicates(), 1)
+
+    def test_failed_subtask_releases_claim(self):
+        d = DummyModel(name="fail")
+        d.save()
+        sprinkler = DedupedSampleSprinkler(raise_error=True)
+        sprinkler.run_id = uuid.uuid4().hex
+        self.assertFalse(sprinkler._run_subtask(d.id))
+        self.assertNotIn(d.id, sprinkler.processed_set)
+        self.assertTrue(sprinkler.processed_set.claim(d.id))
+
+    def test_resumed_sharded_run_skips_processed(self):
+        pks = []
+        for i in range(10):
+            d = DummyModel(name="sharded")
+            d.save()
+            pks.append(d.id)
+        run_id = uuid.uuid4().hex
+        processed_set = ProcessedSet(run_id)
+        for pk in pks[:4]:
+            processed_set.add(pk)
+
+        self._run_deduped(run_deduped_sharded_sprinkler, run_id=run_id, name="sharded")
+        self.assertEqual(set(DummyModel.objects.filter(name="sharded").values_list('id', flat=True)), set(pks[:4]))
+        self.assertEqual(processed_set.duplicates(), 4)
+
+    def test_redelivered_shard_skips_processed(self):
+        pks = []
+        for i in range(6):
+            d = DummyModel(name="sharded")
+            d.save()
+            pks.append(d.id)
+        sprinkler = DedupedShardedSampleSprinkler(name="sharded")
+        sprinkler.run_id = uuid.uuid4().hex
+        processed_set = sprinkler.processed_set
+        # the first delivery of the shard processed two objects and still holds a claim on a third
+        processed_set.start_shard(None, None)
+        processed_set.add(pks[0])
+        processed_set.add(pks[1])
+        processed_set.claim(pks[2])
+
+        self.assertEqual(list(processed_set.unprocessed(pks)), pks[2:])
+        self.assertEqual(processed_set.duplicates(), 2)
+        processed_set.release(pks[2])
+
+        sprinkler.shard_start(uuid.uuid4(), None, None)
+        if not settings.CELERY_ALWAYS_EAGER:
+            time.sleep(2)
+        self.assertEqual(set(DummyModel.objects.filter(name="sharded").values_list('id', flat=True)), set(pks[:2]))
+        self.assertEqual(processed_set.duplicates(), 4)
+        # the finished shard folded its marks into one range
+        self.assertTrue(all(pk in processed_set for pk in pks))
+
+
+class SprinklerRegistryTest(SimpleTestCase):
+
+    def test_lookup_by_name_and_path(self):
+        self.assertIs(sprinkler_registry['SampleSprinkler'], SampleSprinkler)
+        self.assertIs(sprinkler_registry['tests.tasks.SampleSprinkler'], SampleSprinkler)
+
+    def test_path_registration_is_lazy(self):
+        registry = SprinklerRegistry()
+        # Registering a path must not import it, so a bogus one is fine until looked up.
+        registry.register('tests.does_not_exist.MissingSprinkler')
+        registry.register('tests.tasks.SampleSprinkler')
+        self.assertIs(registry['SampleSprinkler'], SampleSprinkler)
+        with self.assertRaises(ImportError):
+            registry['MissingSprinkler']
+
+    def test_name_collision(self):
+        registry = SprinklerRegistry()
+        registry.register('tests.tasks.SampleSprinkler')
+        registry.register('tests.sprinklers.SampleSprinkler')
+        with self.assertRaises(AmbiguousSprinklerName):
+            registry['SampleSprinkler']
+        self.assertIs(registry['tests.tasks.SampleSprinkler'], SampleSprinkler)
+
+    def test_reexported_path_resolves_defining_path(self):
+        registry = SprinklerRegistry()
+        registry.register('tests.test_sprinklers.SampleSprinkler')
+        self.assertIs(registry['tests.tasks.SampleSprinkler'], SampleSprinkler)
+
+
+class SprinklerAutodiscoverTest(SimpleTestCase):
+
+    def setUp(self):
+        # Re-importing the discovered module registers a fresh class on the global registry,
+        # so restore both the module table and the registry afterwards.
+        for patcher in (
+            mock.patch.dict(sys.modules),
+            mock.patch.object(sprinkler_registry, '_paths', dict(sprinkler_registry._paths)),
+            mock.patch.object(sprinkler_registry, '_names',
+                              {name: set(paths) for name, paths in sprinkler_registry._names.items()}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        sys.modules.pop('tests.sprinklers.discovered', None)
+        sys.modules.pop('tests.sprinklers', None)
+
+    def test_autodiscover_is_lazy(self):
+        registry = SprinklerRegistry()
+        registry.autodiscover()
+        self.assertNotIn('tests.sprinklers', sys.modules)
+        sprinkler = registry['tests.sprinklers.discovered.DiscoveredSprinkler']
+        self.assertEqual(sprinkler.__name__, 'DiscoveredSprinkler')
+        self.assertIn('tests.sprinklers', sys.modules)
+
+    def test_bad_discovered_path_is_not_registered(self):
+        registry = SprinklerRegistry()
+        registry.register('tests.tasks.SampleSprinkler')
+        with self.assertRaises(KeyError):
+            registry['tests.sprinklers.discovered.MissingSprinkler']
+        # importable, but not a sprinkler
+        with self.assertRaises(KeyError):
+            registry['tests.sprinklers.discovered.DummyModel']
+        with self.assertRaises(KeyError):
+            registry['tests.sprinklers.discovered.SampleSprinkler']
+        self.assertNotIn('tests.sprinklers.discovered.DummyModel', registry._paths)
+        self.assertIs(registry['SampleSprinkler'], SampleSprinkler)
+
+
+class ProcessedSetTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.processed_set = ProcessedSet(uuid.uuid4().hex)
+
+    def test_ranges(self):
+        ranges = []
+        for pk in [5, 1, 3, 2, 7]:
+            ranges_add(ranges, pk)
+        self.assertEqual(ranges, [[1, 3], [5, 5], [7, 7]])
+        ranges_add(ranges, 6)
+        self.assertEqual(ranges, [[1, 3], [5, 7]])
+        self.assertTrue(ranges_contain(ranges, 2))
+        self.assertFalse(ranges_contain(ranges, 4))
+
+    def test_compact_folds_marks_into_ranges(self):
+        for pk in range(1, 101):
+            self.processed_set.add(pk)
+        self.processed_set.claim(101)
+        self.processed_set.compact(range(1, 102))
+        self.assertEqual(cache.get(self.processed_set._bucket_key(1)), [[1, 100]])
+        self.assertIsNone(cache.get(self.processed_set._claim_key(50)))
+        self.assertIn(50, self.processed_set)
+        self.assertNotIn(101, self.processed_set)
+        # a compacted pk has no claim key, but is still recognised as processed
+        self.assertFalse(self.processed_set.claim(50))
+        self.assertIsNone(cache.get(self.processed_set._claim_key(50)))
+
+    def test_claim_is_exclusive(self):
+        self.assertTrue(self.processed_set.claim(1))
+        with self.assertRaises(SubtaskInProgress):
+            self.processed_set.claim(1)
+        self.processed_set.release(1)
+        self.assertTrue(self.processed_set.claim(1))
+        self.processed_set.add(1)
+        self.assertFalse(self.processed_set.claim(1))
+        self.assertEqual(self.processed_set.duplicates(), 1)
+
+    def test_unprocessed_skips_only_processed(self):
+        self.processed_set.add(2)
+        self.processed_set.add(3)
+        self.processed_set.claim(4)
+        self.assertEqual(list(self.processed_set.unprocessed([1, 2, 3, 4, 5])), [1, 4, 5])
+        self.assertEqual(self.processed_set.duplicates(), 2)
+
+    def test_shard_start_is_recorded(self):
+        self.assertTrue(self.processed_set.start_shard(None, 10))
+        self.assertFalse(self.processed_set.start_shard(None, 10))
+        self.assertTrue(self.processed_set.start_shard(10, None))
+
+    def test_duplicate_count_survives_eviction(self):
+        self.processed_set.record_duplicates()
+        cache.delete(self.processed_set._duplicates_key())
+        self.processed_set.record_duplicates(2)
+        self.assertEqual(self.processed_set.duplicates(), 2)
+
+    def test_runs_are_independent(self):
+        self.processed_set.add(1)
+        self.assertNotIn(1, ProcessedSet(uuid.uuid4().hex))